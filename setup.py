@@ -14,6 +14,9 @@ setup(name='tern_django',
       maintainer='Artem Malyshev',
       maintainer_email='proofit404@gmail.com',
       py_modules=['tern_django'],
+      packages=['tern_django_app',
+                'tern_django_app.management',
+                'tern_django_app.management.commands'],
       entry_points={
           'console_scripts': [
               'tern_django=tern_django:run_tern_django',
@@ -38,6 +38,11 @@
   :group 'tern-django
   :type 'boolean)
 
+(defcustom tern-django-auto-delay 1
+  "Seconds to wait after last save before `tern-django-auto-mode' run."
+  :group 'tern-django
+  :type 'number)
+
 (defvar tern-django-directory (file-name-directory load-file-name)
   "Directory contain `tern-django' package.")
 
@@ -50,6 +55,15 @@
 (defvar tern-django-buffer "*tern-django*"
   "Buffer for `tern-django' process output.")
 
+(defvar tern-django-pending-apps nil
+  "Django applications waiting for next `tern-django' run.")
+
+(defvar tern-django-timer nil
+  "Timer of delayed `tern-django-auto-mode' run.")
+
+(defvar tern-django-status nil
+  "Status of last `tern-django' run shown in the mode line.")
+
 (defun tern-django-p ()
   "Return t if script run inside django environment."
   (stringp (getenv "DJANGO_SETTINGS_MODULE")))
@@ -62,21 +76,21 @@
         (f-join it bin python)
       python)))
 
-(defun tern-django-args ()
-  "Build `tern-django' script options."
-  (let (options)
-    (when tern-django-debug
-      (push "--debug" options))
-    (push tern-django-script options)
-    options))
+(defun tern-django-args (&optional apps)
+  "Build `tern-django' script options.
+Limit script to django APPS directories if specified."
+  (append (list tern-django-script)
+          (when tern-django-debug
+            (list "--debug"))
+          (--mapcat (list "--app" it) apps)))
 
 (defun tern-django-running-p ()
   "Check if `tern-django' process is running."
   (and tern-django-process
        (process-live-p tern-django-process)))
 
-(defun tern-django-bootstrap ()
-  "Start `tern-django' python script."
+(defun tern-django-start (&optional apps)
+  "Start `tern-django' python script for django APPS in background."
   (when (tern-django-p)
     (let ((default-directory tern-django-directory))
       (with-current-buffer
@@ -87,8 +101,27 @@
                    "tern-django"
                    tern-django-buffer
                    (tern-django-python)
-                   (tern-django-args)))
-      (pop-to-buffer tern-django-buffer))))
+                   (tern-django-args apps)))
+      (set-process-sentinel tern-django-process 'tern-django-sentinel)
+      (setq tern-django-status "run")
+      (force-mode-line-update t)
+      tern-django-process)))
+
+(defun tern-django-bootstrap ()
+  "Start `tern-django' python script."
+  (when (tern-django-start)
+    (pop-to-buffer tern-django-buffer)))
+
+(defun tern-django-sentinel (process _event)
+  "Update `tern-django' status after PROCESS exit.
+Start next run if some applications were saved meanwhile."
+  (unless (process-live-p process)
+    (setq tern-django-status
+          (cond ((not (zerop (process-exit-status process))) "fail")
+                (tern-django-pending-apps "queue")))
+    (force-mode-line-update t)
+    (when tern-django-pending-apps
+      (tern-django-schedule))))
 
 (defun tern-django-terminate ()
   "Terminate `tern-django' python script."
@@ -106,6 +139,63 @@
   (unless (tern-django-running-p)
     (tern-django-bootstrap)))
 
+(defun tern-django-app-directory (file)
+  "Return django application directory of saved FILE.
+Only templates and static javascript files are considered.  Last
+templates or static directory with namespace directory under it is
+preferred, so project may live under directory of the same name."
+  (let ((path (f-full file))
+        (entry (cond
+                ((string-match-p "\\.html\\'" file) "templates")
+                ((string-match-p "\\.js\\'" file) "static"))))
+    (when (and entry
+               (--first (string-match (concat "\\`\\(.+\\)/" entry it) path)
+                        '("/[^/]+/" "/")))
+      (match-string 1 path))))
+
+(defun tern-django-schedule ()
+  "Run `tern-django' for pending applications after a delay.
+Each call postpones the run, so series of saves cause single run."
+  (when (timerp tern-django-timer)
+    (cancel-timer tern-django-timer))
+  (setq tern-django-timer
+        (run-with-timer tern-django-auto-delay nil 'tern-django-run-pending)))
+
+(defun tern-django-run-pending ()
+  "Run `tern-django' for all pending applications at once.
+Applications stay pending while other process is running."
+  (setq tern-django-timer nil)
+  (when (and tern-django-pending-apps
+             (not (tern-django-running-p)))
+    (let ((apps (reverse tern-django-pending-apps)))
+      (setq tern-django-pending-apps nil)
+      (tern-django-start apps))))
+
+(defun tern-django-after-save ()
+  "Queue application of current buffer for `tern-django' run."
+  (--when-let (and buffer-file-name
+                   (tern-django-p)
+                   (tern-django-app-directory buffer-file-name))
+    (add-to-list 'tern-django-pending-apps it)
+    (setq tern-django-status "queue")
+    (tern-django-schedule)))
+
+(defun tern-django-lighter ()
+  "Mode line lighter of `tern-django-auto-mode'."
+  (if tern-django-status
+      (format " TD[%s]" tern-django-status)
+    " TD"))
+
+;;;###autoload
+(define-minor-mode tern-django-auto-mode
+  "Update tern projects when django templates or static files are saved."
+  :global t
+  :group 'tern-django
+  :lighter (:eval (tern-django-lighter))
+  (if tern-django-auto-mode
+      (add-hook 'after-save-hook 'tern-django-after-save)
+    (remove-hook 'after-save-hook 'tern-django-after-save)))
+
 (provide 'tern-django)
 
 ;;; tern-django.el ends here
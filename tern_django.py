@@ -10,20 +10,37 @@
     :license: GPL3, see LICENSE for more details.
 """
 
+import cProfile
 import logging
+import mmap
 import multiprocessing
+import pstats
 import re
 import sqlite3
 import sys
+import tarfile
+from codecs import getincrementaldecoder
 from hashlib import sha256
+from io import BytesIO
 try:
     from html.parser import HTMLParser, HTMLParseError
 except ImportError:
     from HTMLParser import HTMLParser, HTMLParseError
 from json import dumps, loads
-from os import makedirs, walk
+from os import close, environ, listdir, makedirs, sep, stat, walk
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 from os.path import (
-    abspath, basename, dirname, exists, expanduser, getmtime, join)
+    abspath, basename, dirname, exists, expanduser, getmtime, getsize, isabs,
+    isdir, isfile, islink, join)
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from time import time
 try:
     from urllib.parse import urlsplit
 except ImportError:
@@ -38,16 +55,18 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
 from django.template import Template, Context
+from django.template.base import Lexer, TOKEN_BLOCK, TOKEN_TEXT
 
 
 logger = multiprocessing.get_logger()
 
-django_version = django.get_version()
 tern_file = '.tern-project'
 
+static_pattern = 'static/**/*.js'
+
 default_tern_project = {
     'libs': ['browser', 'ecma5'],
-    'loadEagerly': ['static/**/*.js'],
+    'loadEagerly': [static_pattern],
 }
 
 
@@ -58,30 +77,78 @@ def run_tern_django():
 
     init_logging()
     init_cache()
-    update_tern_projects()
+    bundle = get_option('--export-storage')
+    if bundle:
+        export_storage(bundle)
+        return
+    bundle = get_option('--import-storage')
+    if bundle:
+        import_storage(bundle)
+        return
+    global offline, trust_directories, eager_budget
+    offline = '--offline' in sys.argv
+    trust_directories = '--trust-directory-mtime' in sys.argv
+    budget = get_option('--eager-budget')
+    if budget:
+        eager_budget = int(budget)
+    options = {
+        'resume': '--resume' in sys.argv,
+        'targets': get_options('--app'),
+    }
+    settings_modules = get_option('--settings')
+    if settings_modules:
+        options['settings_modules'] = settings_modules.split(',')
+    budget = get_option('--budget')
+    if budget:
+        options['budget'] = float(budget)
+    profile = get_option('--profile')
+    if profile:
+        collapsed = get_option('--profile-collapsed')
+        profile_tern_projects(profile, collapsed, **options)
+    else:
+        update_tern_projects(**options)
 
 
-def init_logging():
+def get_option(name):
+    """Get command line option value if specified."""
+
+    if name in sys.argv:
+        index = sys.argv.index(name) + 1
+        if index < len(sys.argv):
+            return sys.argv[index]
+
+
+def get_options(name):
+    """Get all values of command line option specified several times."""
+
+    return [value for option, value in zip(sys.argv, sys.argv[1:])
+            if option == name]
+
+
+def init_logging(debug=None):
     """Initialize logging system."""
 
-    debug = '--debug' in sys.argv
+    if debug is None:
+        debug = '--debug' in sys.argv
     level = logging.DEBUG if debug else logging.INFO
     multiprocessing.log_to_stderr()
     logger.setLevel(level)
 
 
 def initialize():
-    """Initialize django applications."""
+    """Initialize django applications if necessary."""
 
-    if django_version >= '1.7':
-        django.setup()
+    if django.VERSION[:2] >= (1, 7):
+        from django.apps import apps
+        if not apps.ready:
+            django.setup()
 
 
 def applications():
     """Collect directories with django applications."""
 
     initialize()
-    if django_version >= '1.7':
+    if django.VERSION[:2] >= (1, 7):
         from django.apps import apps
         return [app.path for app in apps.get_app_configs()]
     else:
@@ -99,43 +166,255 @@ def applications():
 # Tern project saving.
 
 
-def update_tern_projects():
-    """Update tern projects in each django application."""
+def update_tern_projects(resume=False, profile=None, settings_modules=None,
+                         targets=None, budget=None):
+    """Update tern projects in each django application.
+
+    Progress of each application is saved into cache.  In resume mode
+    applications completed by previous run will be skipped.  If profile
+    directory is specified, each worker will save its statistics there.
 
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count() * 2)
+    If list of settings modules is specified, each django project is
+    processed by its own group of workers at the same time.
+    Applications shared between projects are processed only once.
+    Workers inherit django state of this process, so it must not be
+    configured yet.
+
+    If list of target directories is specified, only these applications
+    will be processed.
+
+    If time budget in seconds is specified, recently changed
+    applications are processed first.  Applications not started before
+    the deadline are left for the next run, applications already
+    running are finished.
+    """
+
+    if settings_modules and settings.configured:
+        raise RuntimeError('Django settings are already configured, '
+                           'other settings modules can not be processed')
+    deadline = time() + budget if budget is not None else None
+    previous = completed_applications() if budget is not None else set()
+    if not resume and not targets:
+        clear_app_cache()
+    if settings_modules:
+        processes = max(1, worker_count() // len(settings_modules))
+        pools = [create_pool(processes, profile, module, deadline)
+                 for module in settings_modules]
+    else:
+        pools = [create_pool(worker_count(), profile, None, deadline)]
     try:
-        pool.map(update_application, applications())
+        if settings_modules:
+            projects = [pool.apply_async(applications) for pool in pools]
+            projects = [project.get() for project in projects]
+        else:
+            projects = [applications()]
+        projects = project_applications(projects, resume, targets)
+        if deadline is not None:
+            projects = [prioritize_applications(apps, previous)
+                        for apps in projects]
+        # Keep priority order when time budget is specified.
+        chunksize = 1 if deadline is not None else None
+        results = [pool.map_async(process_application, apps, chunksize)
+                   for pool, apps in zip(pools, projects)]
+        statuses = [status for result in results for status in result.get()]
     finally:
-        pool.close()
-        pool.join()
+        for pool in pools:
+            pool.close()
+            pool.join()
+    apps = [app for apps in projects for app in apps]
+    skipped = [app for app, status in zip(apps, statuses)
+               if status == 'skipped']
+    if skipped:
+        logger.warning('Time budget exceeded, %d applications left for '
+                       'next run', len(skipped))
+    failed = [app for app, status in zip(apps, statuses)
+              if status not in ('done', 'skipped')]
+    if failed:
+        logger.warning('Fail to complete %d applications, run with '
+                       '--resume option to retry them: %s',
+                       len(failed), ', '.join(failed))
+
+
+def project_applications(projects, resume=False, targets=None):
+    """Choose applications each project should process.
+
+    Application shared between several projects will be processed by
+    the first one.  In resume mode completed applications are skipped.
+    Only target applications are processed if targets are specified.
+    Installed third party applications are never processed.
+    """
+
+    seen = completed_applications() if resume else set()
+    if targets:
+        targets = set(abspath(target) for target in targets)
+    result = []
+    for apps in projects:
+        apps = [app for app in apps
+                if app not in seen and not immutable_application(app)]
+        if targets:
+            apps = [app for app in apps if abspath(app) in targets]
+        seen.update(apps)
+        result.append(apps)
+    if resume:
+        logger.info('Resume run, %d applications left',
+                    sum(len(apps) for apps in result))
+    return result
+
+
+installed_directories = ('site-packages', 'dist-packages')
+
+
+def immutable_application(app):
+    """Check if application is installed third party package.
+
+    We can't edit such applications, so we don't need tern projects in
+    it.  Its static files are still available for other applications.
+    """
+
+    parts = abspath(app).split(sep)
+    if any(directory in parts for directory in installed_directories):
+        logger.debug('Skip installed application: %s', app)
+        return True
+    return False
+
+
+def prioritize_applications(apps, previous=()):
+    """Sort applications by priority.
+
+    Applications not completed by previous run go first.  Recently
+    changed applications go before others.
+    """
+
+    mtimes = dict((app, directories_mtime(app)) for app in apps)
+    return sorted(apps, key=lambda app: (app in previous, -mtimes[app]))
+
+
+def directories_mtime(app):
+    """Latest modification time of application templates and static
+    directories.
+
+    Only top two directory levels are checked, so ranking doesn't eat
+    time budget on large applications.  Adding, removing or replacing
+    files there updates directory mtime.
+    """
+
+    latest = 0
+    for directory in ['templates', 'static']:
+        directory = join(app, directory)
+        try:
+            names = listdir(directory)
+            latest = max(latest, getmtime(directory))
+        except OSError:
+            continue            # Directory doesn't exist.
+        for name in names:
+            path = join(directory, name)
+            try:
+                if isdir(path):
+                    latest = max(latest, getmtime(path))
+            except OSError:
+                pass            # Directory was removed during check.
+    return latest
+
+
+def worker_count():
+    """Number of worker processes used for whole run."""
+
+    return multiprocessing.cpu_count() * 2
+
+
+def create_pool(processes, profile=None, settings_module=None,
+                deadline=None):
+    """Create group of initialized worker processes."""
+
+    return multiprocessing.Pool(processes=processes,
+                                initializer=init_worker,
+                                initargs=(profile, offline, settings_module,
+                                          deadline, trust_directories,
+                                          eager_budget))
+
+
+def init_worker(profile=None, offline_mode=False, settings_module=None,
+                deadline_time=None, trust_mode=False, budget=None):
+    """Initialize pool worker process."""
+
+    global profile_directory, offline, deadline, trust_directories
+    global eager_budget
+    profile_directory = profile
+    offline = offline_mode
+    deadline = deadline_time
+    trust_directories = trust_mode
+    if budget is not None:
+        eager_budget = budget
+    if settings_module:
+        environ['DJANGO_SETTINGS_MODULE'] = settings_module
+
+
+deadline = None
+
+
+def process_application(app):
+    """Update application inside pool worker.  Profile it if necessary.
+
+    Application is skipped if run deadline has already passed.
+    """
+
+    if deadline is not None and time() > deadline:
+        logger.debug('Skip application after deadline: %s', app)
+        return 'skipped'
+    if profile_directory is None:
+        return update_application(app)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(update_application, app)
+    finally:
+        descriptor, stats_file = mkstemp(suffix='.prof', dir=profile_directory)
+        close(descriptor)
+        profiler.dump_stats(stats_file)
 
 
 def update_application(app):
-    """Update tern project in specified django application."""
+    """Update tern project in specified django application.
 
+    Return application status saved into cache.  Errors are logged and
+    don't affect other applications.  Installed third party
+    applications are left as is.
+    """
+
+    logger.debug('Update application: %s', app)
     try:
         initialize()                # One more time for child process.
         static = join(app, 'static')
-        if exists(static):
+        failures = []
+        if exists(static) and not immutable_application(app):
             project_file = join(app, tern_file)
-            templates_tern_project = analyze_templates(app)
+            templates_tern_project = analyze_templates(app, failures)
             tern_project = merge_projects(
                 default_tern_project,
                 templates_tern_project)
+            tern_project['loadEagerly'] = eager_files(
+                app, tern_project['loadEagerly'])
             save_tern_project(tern_project, project_file)
+        status = 'partial' if failures else 'done'
+        set_app_cache(app, status)
     except Exception as error:
         logger.exception('Unexpected error occurs: %s', error)
-        raise
+        status = 'failed'
+        set_app_cache(app, status)
+    return status
 
 
 def merge_projects(*projects):
-    """Merge non empty projects all together."""
+    """Merge non empty projects all together.
+
+    Values are sorted, so result doesn't depend on the process which
+    merged it.
+    """
 
     non_empty = list(filter(None, projects))  # We need list to reuse it.
     keys = set((k for project in non_empty for k in project))
-    return dict(((k, list(set((v
-                               for project in non_empty
-                               for v in project[k]))))
+    return dict(((k, sorted(set((v
+                                 for project in non_empty
+                                 for v in project[k]))))
                  for k in keys))
 
 
@@ -156,80 +435,377 @@ def write_tern_project(tern_project, project_file):
 
     logger.info('Write tern project to %s', project_file)
     with open(project_file, 'w') as project:
-        project.write(dumps(tern_project))
+        project.write(dumps(tern_project, sort_keys=True))
+
+
+# Eager loading.
+
+
+eager_budget = 2 * 1024 * 1024
+
+minified_suffixes = ('.min.js', '-min.js')
+
+file_hashes = {}
+
+
+def eager_files(app, paths):
+    """Choose files tern should load eagerly.
+
+    Files with same content are loaded once.  Copy from the application
+    itself or from the storage is preferred.  Non minified version of
+    library is used if it's placed next to minified one.  Files are
+    added smallest first while they fit into eager_budget bytes.
+    Budget of zero or less means no limit.
+    """
+
+    patterns = [path for path in paths if not isabs(path)]
+    files = [unminified(path) for path in paths
+             if isabs(path) and isfile(path)]
+    app_hashes = set()
+    if files and static_pattern in patterns:
+        sizes = set(getsize(path) for path in files)
+        app_hashes = set(file_hash(path) for path in static_scripts(app)
+                         if getsize(path) in sizes)
+    unique = {}
+    for path in sorted(files, key=eager_priority):
+        digest = file_hash(path)
+        if digest not in app_hashes and digest not in unique:
+            unique[digest] = path
+    selected = []
+    total = 0
+    for path in sorted(unique.values(), key=lambda p: (getsize(p), p)):
+        size = getsize(path)
+        if 0 < eager_budget < total + size:
+            logger.info('Skip eager loading of %s (%d bytes)', path, size)
+            continue
+        total += size
+        selected.append(path)
+    return sorted(patterns + selected)
+
+
+def eager_priority(path):
+    """Sort key preferring files from the storage."""
+
+    return not path.startswith(storage), path
+
+
+def unminified(path):
+    """Find non minified version of javascript file if exists."""
+
+    for suffix in minified_suffixes:
+        if path.endswith(suffix):
+            source = path[:-len(suffix)] + '.js'
+            if isfile(source):
+                return source
+    return path
+
+
+def static_scripts(app):
+    """Find javascript files loaded by application static pattern."""
+
+    for root, dirs, files in walk(join(app, 'static')):
+        for name in files:
+            if name.endswith('.js'):
+                yield join(root, name)
+
+
+def file_hash(path):
+    """Count sha256 hash for file content.  Remember it for unchanged file.
+
+    Hashes are saved into cache, so next runs don't read files again.
+    File changed within last mtime tick is hashed each time.
+    """
+
+    info = stat(path)
+    key = (path, info.st_mtime, info.st_size)
+    if key not in file_hashes:
+        cache = get_hash_cache(path)
+        if cache and tuple(cache[:2]) == key[1:]:
+            file_hashes[key] = cache[2]
+        else:
+            digest = sha256()
+            with open(path, 'rb') as content:
+                for block in iter(lambda: content.read(chunk_size), b''):
+                    digest.update(block)
+            file_hashes[key] = digest.hexdigest()
+            if not recently_modified(info.st_mtime):
+                set_hash_cache(path, info.st_mtime, info.st_size,
+                               file_hashes[key])
+    return file_hashes[key]
+
+
+# Profiling.
+
+
+profile_directory = None
+
+
+def profile_tern_projects(profile_file, collapsed_file=None, **options):
+    """Update tern projects under profiler.
+
+    Statistics of parent process and all pool workers are merged into
+    single pstats file.  Other options are passed to
+    update_tern_projects as is.
+    """
+
+    directory = mkdtemp(prefix='tern-django-profile-')
+    try:
+        profiler = cProfile.Profile()
+        profiler.runcall(update_tern_projects, profile=directory, **options)
+        stats = pstats.Stats(profiler)
+        for name in listdir(directory):
+            stats.add(join(directory, name))
+    finally:
+        rmtree(directory)
+    logger.info('Write profile statistics to %s', profile_file)
+    stats.dump_stats(profile_file)
+    if collapsed_file:
+        logger.info('Write collapsed stacks to %s', collapsed_file)
+        write_collapsed_stacks(stats, collapsed_file)
+
+
+collapsed_resolution = 0.000001
+
+collapsed_stacks_limit = 100000
+
+
+def write_collapsed_stacks(stats, collapsed_file):
+    """Save statistics in flamegraph collapsed stack format.
+
+    cProfile doesn't record whole call stacks, so time of each function
+    is split between its callers in proportion of the time spent in
+    each call.  Values are written in microseconds.
+    """
+
+    callees = {}
+    roots = []
+    for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge))
+    samples = {}
+    remaining = [collapsed_stacks_limit]
+    for root in roots:
+        collapse_stack(stats, callees, samples, remaining,
+                       function_label(root), set([root]), root, 1.0)
+    if remaining[0] <= 0:
+        logger.warning('Collapsed stacks limit reached, deep calls are '
+                       'merged into its callers')
+    with open(collapsed_file, 'w') as collapsed:
+        for stack in sorted(samples):
+            value = int(samples[stack] * 1000000)
+            if value:
+                collapsed.write('{0} {1}\n'.format(stack, value))
+
+
+def collapse_stack(stats, callees, samples, remaining, key, stack,
+                   function, fraction):
+    """Accumulate function self time for given call stack.
+
+    Callees which spend less than output resolution on this stack are
+    counted as function self time.  So are all callees once the stack
+    is too deep or the limit of visited stacks is exhausted.
+    """
+
+    cc, nc, tt, ct, callers = stats.stats[function]
+    remaining[0] -= 1
+    if len(stack) >= 128 or remaining[0] <= 0:
+        own = ct * fraction
+    else:
+        own = tt * fraction
+        for callee, edge in callees.get(function, []):
+            if callee in stack:
+                continue        # Recursive call.
+            callee_ct = stats.stats[callee][3]
+            edge_ct = edge[3] if isinstance(edge, tuple) else 0
+            if not edge_ct or not callee_ct:
+                continue
+            if edge_ct * fraction < collapsed_resolution:
+                own += edge_ct * fraction
+                continue
+            stack.add(callee)
+            collapse_stack(stats, callees, samples, remaining,
+                           key + ';' + function_label(callee), stack,
+                           callee, fraction * edge_ct / callee_ct)
+            stack.discard(callee)
+    samples[key] = samples.get(key, 0) + own
+
+
+def function_label(function):
+    """Format pstats function key as flamegraph frame."""
+
+    file_name, line, name = function
+    if file_name == '~':
+        return name             # Builtin function.
+    return '{0}:{1}({2})'.format(basename(file_name), line, name)
 
 
 # Templates analyze.
 
 
-def analyze_templates(app):
-    """Add to project properties grabbed from app templates."""
+trust_directories = False
+
+
+def analyze_templates(app, failures=None):
+    """Add to project properties grabbed from app templates.
+
+    Templates we fail to process will be appended to failures list.
+    """
 
     projects = []
     templates = join(app, 'templates')
-    for root, dirs, files in walk(templates):
-        htmls = [join(root, f) for f in files if f.endswith('.html')]
-        for html in htmls:
-            projects.append(process_html_template(html, app))
+    for html, mtime in template_files(templates):
+        projects.append(process_html_template(html, app, failures, mtime))
     return merge_projects(*projects)
 
 
-def process_html_template(html, app):
-    """Grab static files from html template."""
+def template_files(directory):
+    """Find html templates in directory tree with its modification times.
+
+    If trust_directories is enabled, directory listings are saved into
+    cache.  Directory which mtime wasn't changed since then is listed
+    from cache without stat-ing its files.  Any mismatch leads to
+    regular directory scan.
+    """
+
+    try:
+        mtime = getmtime(directory)
+    except OSError:
+        return []               # Directory doesn't exist.
+    snapshot = get_dir_cache(directory) if trust_directories else None
+    if snapshot and snapshot[0] == mtime:
+        files, dirs = loads(snapshot[1]), loads(snapshot[2])
+    else:
+        try:
+            files, dirs = scan_directory(directory)
+        except OSError:
+            return []           # Directory was removed during scan.
+        # Directory changed within last mtime tick may change again
+        # without mtime update, so we don't trust its listing.
+        if trust_directories and not recently_modified(mtime):
+            set_dir_cache(directory, mtime, dumps(files), dumps(dirs))
+    result = [(join(directory, name), file_mtime)
+              for name, file_mtime in files]
+    for name in dirs:
+        result.extend(template_files(join(directory, name)))
+    return result
+
+
+def scan_directory(directory):
+    """List html files with its mtime and subdirectories of directory.
+
+    Use scandir if available, so we stat each file only once.  Symbolic
+    links to directories aren't followed.
+    """
+
+    files, dirs = [], []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.name.endswith('.html') and not entry.is_dir():
+                files.append((entry.name, entry.stat().st_mtime))
+    else:
+        for name in listdir(directory):
+            path = join(directory, name)
+            if isdir(path):
+                if not islink(path):
+                    dirs.append(name)
+            elif name.endswith('.html'):
+                files.append((name, getmtime(path)))
+    return sorted(files), sorted(dirs)
+
+
+def process_html_template(html, app, failures=None, mtime=None):
+    """Grab static files from html template.
+
+    Template mtime will be obtained from file system if not specified.
+    """
 
     logger.debug('Process template: {0}'.format(html))
 
-    cached = get_template_cache(html)
+    if mtime is None:
+        mtime = getmtime(html)
+
+    cached = get_template_cache(html, mtime)
     if cached:
         libs, loadEagerly = cached
         return {'libs': libs, 'loadEagerly': loadEagerly}
 
     with open(html, 'rb') as template:
-        source = template.read().decode(settings.FILE_CHARSET)
+        meaningful, rendering = scan_template(template)
+        if not meaningful:
+            set_template_cache(html, mtime=mtime)
+            return
+        try:
+            libs, loadEagerly = parse_template_chunks(
+                template_chunks(template, rendering), app)
+        except URLError:
+            # Fail to download external library.  Don't cache this
+            # template so next run will try to download it again.
+            if failures is not None:
+                failures.append(html)
+            return
 
-    if not meaningful_template(source):
-        set_template_cache(html)
-        return
+    set_template_cache(html, libs, loadEagerly, mtime)
+    return {'libs': libs, 'loadEagerly': loadEagerly}
 
-    try:
-        libs, loadEagerly = parse_template(source, app)
-    except URLError:
-        pass                    # Fail to download external library.
-    else:
-        set_template_cache(html, libs, loadEagerly)
-        return {'libs': libs, 'loadEagerly': loadEagerly}
 
+def get_template_cache(html_file, mtime=None):
+    """Check database cache for html file information.
 
-def get_template_cache(html_file):
-    """Check database cache for html file information."""
+    Cache is valid if template wasn't modified since it was analyzed.
+    """
 
     cache = get_html_cache(html_file)
     if cache:
         cache_mtime, cache_libs, cache_eagerly = cache
-        mtime = getmtime(html_file)
-        if mtime < cache_mtime:
-            libs = loads(cache_libs) if cache_libs else []
-            loadEagerly = loads(cache_eagerly) if cache_eagerly else []
-            return libs, loadEagerly
+        if mtime is None:
+            mtime = getmtime(html_file)
+        if mtime <= cache_mtime:
+            # Templates without scripts are saved with null values.
+            libs = cache_libs and loads(cache_libs)
+            loadEagerly = cache_eagerly and loads(cache_eagerly)
+            return libs or [], loadEagerly or []
 
 
-def set_template_cache(html_file, libs=None, loadEagerly=None):
-    """Save html file information into database cache."""
+def set_template_cache(html_file, libs=None, loadEagerly=None, mtime=None):
+    """Save html file information into database cache.
 
-    mtime = getmtime(html_file)
+    Template changed within last mtime tick is saved as older one, so
+    it will be analyzed again by next run.
+    """
+
+    if mtime is None:
+        mtime = getmtime(html_file)
+    if recently_modified(mtime):
+        mtime -= mtime_resolution
     set_html_cache(html_file, mtime, dumps(libs), dumps(loadEagerly))
 
 
-def parse_template(source, app):
-    """Parse html source string.  Save information in the project."""
+mtime_resolution = 2
+
 
-    rendered_source = render_template_if_necessary(source)
+def recently_modified(mtime):
+    """Check if file may change again without mtime update.
+
+    Some file systems store mtime with up to two seconds resolution.
+    """
+
+    return time() - mtime <= mtime_resolution
+
+
+def parse_template_chunks(chunks, app):
+    """Parse already rendered html source chunk by chunk."""
+
+    parser = TemplateParser()
+    # Don't move this to TemplateParser init.  Super will not
+    # properly work with this class in python2.x
+    parser.src = []
     try:
-        parser = TemplateParser()
-        # Don't move this to TemplateParser init.  Super will not
-        # properly work with this class in python2.x
-        parser.src = []
-        parser.feed(rendered_source)
+        for chunk in chunks:
+            parser.feed(chunk)
     except HTMLParseError:
         pass
     analyzer = TemplateAnalyzer(app, parser.src)
@@ -321,47 +897,125 @@ def meaningful_template(template):
     return '<script' in template and '</script>' in template
 
 
+# Template reading.
+
+
+chunk_size = 64 * 1024
+
+
+def scan_template(template):
+    """Check raw template file without decoding it.
+
+    Return pair of flags.  First one tells if template is meaningful,
+    second one tells if template loads static tags and needs to be
+    rendered.
+    """
+
+    if not ascii_compatible_charset():
+        # We can't search markers in raw bytes of such encoding.
+        source = template.read().decode(settings.FILE_CHARSET)
+        template.seek(0)
+        return meaningful_template(source), needs_to_be_rendered(source)
+    try:
+        content = mmap.mmap(template.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return False, False     # Empty file can't be mapped.
+    try:
+        meaningful = (content.find(b'<script') != -1 and
+                      content.find(b'</script>') != -1)
+        rendering = load_static_bytes_regex.search(content) is not None
+    finally:
+        content.close()
+    return meaningful, rendering
+
+
+def ascii_compatible_charset():
+    """Check if template charset encodes html markup as plain ascii."""
+
+    return '<script'.encode(settings.FILE_CHARSET) == b'<script'
+
+
+def template_chunks(template, rendering):
+    """Read and decode template file chunk by chunk.
+
+    Chunks are split on line boundaries if template needs to be
+    rendered, since template tags can't span multiple lines.
+    """
+
+    decoder = getincrementaldecoder(settings.FILE_CHARSET)()
+    tail = ''
+    while True:
+        block = template.read(chunk_size)
+        chunk = tail + decoder.decode(block, not block)
+        tail = ''
+        if block and rendering:
+            boundary = chunk.rfind('\n') + 1
+            chunk, tail = chunk[:boundary], chunk[boundary:]
+        if chunk:
+            yield render_chunk(chunk) if rendering else chunk
+        if not block:
+            break
+
+
 # Template rendering.
 
 
-template_tag_regex = re.compile(r'{%.*%}|{{.*}}|{#.*#}')
-static_tag_regex = re.compile(r'{%\s*static\s*.*\s*%}')
+load_static_regex = re.compile(
+    r'{%\s*load\s[^%]*\bstatic(files)?\b[^%]*%}')
+load_static_bytes_regex = re.compile(
+    br'{%\s*load\s[^%]*\bstatic(files)?\b[^%]*%}')
+
+rendered_static_tags = {}
+
+
+def render_chunk(chunk):
+    """Render part of django template known to load static tags.
+
+    Template is split into tokens with django lexer in single pass.
+    Text tokens are kept as is and static tags are rendered.  We have
+    interest in static template tags only so we will omit other tags.
+    """
+
+    rendered = []
+    for token in template_lexer(chunk).tokenize():
+        if token.token_type == TOKEN_TEXT:
+            rendered.append(token.contents)
+        elif (token.token_type == TOKEN_BLOCK and
+              token.contents.split()[:1] == ['static']):
+            rendered.append(render_static_tag(token.contents))
+    return ''.join(rendered)
 
 
-def render_template_if_necessary(source):
-    """Render django template if necessary."""
+def template_lexer(source):
+    """Create django template lexer for given source."""
 
-    if needs_to_be_rendered(source):
-        rendered_source = template_tag_regex.sub(render_node, source)
-        return rendered_source
+    if django.VERSION[:2] >= (1, 9):
+        return Lexer(source)
     else:
-        return source
+        return Lexer(source, None)
 
 
-def render_node(node):
-    """Render one template node.
-    Templates node has represented by regex match objects.
-    We have interest in static template tags only so we will omit other tags.
-    """
+def render_static_tag(contents):
+    """Render one static template tag.  Remember rendered result."""
 
-    token = node.group(0)
-    if static_tag_regex.match(token):
-        template = Template('{% load staticfiles %}' + token)
-        context = Context({})
+    if contents not in rendered_static_tags:
+        if 'django.contrib.staticfiles' in settings.INSTALLED_APPS:
+            library = 'staticfiles'
+        else:
+            library = 'static'
+        source = '{% load ' + library + ' %}{% ' + contents + ' %}'
         try:
-            rendered = template.render(context)
+            rendered = Template(source).render(Context({}))
         except Exception:
-            return ''               # Ignore any rendering error.
-        else:
-            return rendered
-    else:
-        return ''               # Ignore any other tags.
+            rendered = ''       # Ignore any malformed or failed tag.
+        rendered_static_tags[contents] = rendered
+    return rendered_static_tags[contents]
 
 
 def needs_to_be_rendered(template):
     """Check if template has necessary django tags"""
 
-    return '{% load staticfiles %}' in template
+    return load_static_regex.search(template) is not None
 
 
 # Sql cache.
@@ -407,6 +1061,22 @@ def init_cache():
             "id" integer primary key,
             "url" text unique not null,
             "sha256" text not null);
+        create table if not exists dir_cache (
+            "id" integer primary key,
+            "directory" text unique not null,
+            "mtime" real,
+            "files" text,
+            "dirs" text);
+        create table if not exists app_cache (
+            "id" integer primary key,
+            "app" text unique not null,
+            "status" text not null);
+        create table if not exists hash_cache (
+            "id" integer primary key,
+            "file_name" text unique not null,
+            "mtime" real,
+            "size" integer,
+            "sha256" text not null);
         """)
 
 
@@ -417,6 +1087,9 @@ def drop_cache():
         connection.executescript("""
         drop table if exists html_cache;
         drop table if exists url_cache;
+        drop table if exists dir_cache;
+        drop table if exists app_cache;
+        drop table if exists hash_cache;
         """)
 
 
@@ -471,20 +1144,120 @@ def get_url_cache(url):
 
 
 def set_url_cache(url, sha256):
-    """Set sha256 value for file placed at given url."""
+    """Set sha256 value for file placed at given url.
+
+    Workers of different projects may download the same url at once.
+    """
 
     with Cache() as connection:
-        if get_url_cache(url):
-            query = """
-            update url_cache set "sha256"=:sha256
-            where "url"=:url;
-            """
-        else:
-            query = """
-            insert into url_cache("url", "sha256")
-            values (:url, :sha256);
-            """
-        connection.execute(query, {'url': url, 'sha256': sha256})
+        connection.execute("""
+        insert or replace into url_cache("url", "sha256")
+        values (:url, :sha256);
+        """, {'url': url, 'sha256': sha256})
+
+
+def get_dir_cache(directory):
+    """Get directory listing snapshot if exists."""
+
+    with Cache() as connection:
+        cursor = connection.execute("""
+        select "mtime", "files", "dirs"
+        from dir_cache
+        where "directory"=?;
+        """, (directory,))
+        return cursor.fetchone()
+
+
+def set_dir_cache(directory, mtime, files, dirs):
+    """Save directory listing snapshot."""
+
+    with Cache() as connection:
+        connection.execute("""
+        insert or replace into dir_cache("directory", "mtime", "files", "dirs")
+        values (:directory, :mtime, :files, :dirs);
+        """, {'directory': directory, 'mtime': mtime,
+              'files': files, 'dirs': dirs})
+
+
+def all_url_cache():
+    """Get all known urls with sha256 of its files."""
+
+    with Cache() as connection:
+        cursor = connection.execute("""
+        select "url", "sha256"
+        from url_cache
+        order by "url";
+        """)
+        return cursor.fetchall()
+
+
+def get_app_cache(app):
+    """Get application status if exists."""
+
+    with Cache() as connection:
+        cursor = connection.execute("""
+        select "status"
+        from app_cache
+        where "app"=?;
+        """, (app,))
+        received = cursor.fetchone()
+        if received:
+            return received[0]
+
+
+def set_app_cache(app, status):
+    """Save application status."""
+
+    with Cache() as connection:
+        connection.execute("""
+        insert or replace into app_cache("app", "status")
+        values (:app, :status);
+        """, {'app': app, 'status': status})
+
+
+def completed_applications():
+    """Get applications successfully processed by previous run."""
+
+    with Cache() as connection:
+        cursor = connection.execute("""
+        select "app"
+        from app_cache
+        where "status"='done';
+        """)
+        return set(row[0] for row in cursor.fetchall())
+
+
+def clear_app_cache():
+    """Forget progress of previous run."""
+
+    with Cache() as connection:
+        connection.execute("""
+        delete from app_cache;
+        """)
+
+
+def get_hash_cache(file_name):
+    """Get file content sha256 with file mtime and size if exists."""
+
+    with Cache() as connection:
+        cursor = connection.execute("""
+        select "mtime", "size", "sha256"
+        from hash_cache
+        where "file_name"=?;
+        """, (file_name,))
+        return cursor.fetchone()
+
+
+def set_hash_cache(file_name, mtime, size, sha256):
+    """Save file content sha256 with file mtime and size."""
+
+    with Cache() as connection:
+        connection.execute("""
+        insert or replace into hash_cache("file_name", "mtime", "size",
+                                          "sha256")
+        values (:file_name, :mtime, :size, :sha256);
+        """, {'file_name': file_name, 'mtime': mtime, 'size': size,
+              'sha256': sha256})
 
 
 # Libraries download.
@@ -492,6 +1265,8 @@ def set_url_cache(url, sha256):
 
 storage = expanduser('~/.emacs.d/tern-django-storage')
 
+offline = False
+
 
 def create_storage():
     """Create storage directory if necessary."""
@@ -511,6 +1286,10 @@ def download_library(url):
         if exists(stored_library):
             return stored_library
 
+    if offline:
+        logger.error('External library missed from storage: %s', url)
+        raise URLError('Offline mode.')
+
     create_storage()
     try:
         response = urlopen(url)
@@ -538,5 +1317,60 @@ def content_hash(content):
     return hexdigest
 
 
+# Storage bundles.
+
+
+bundle_index = 'url_cache.json'
+
+
+def export_storage(bundle):
+    """Pack url cache and stored libraries into single archive."""
+
+    logger.info('Export storage to %s', bundle)
+    index = [{'url': url, 'sha256': hexdigest}
+             for url, hexdigest in all_url_cache()
+             if exists(join(storage, hexdigest))]
+    content = dumps(index).encode()
+    info = tarfile.TarInfo(bundle_index)
+    info.size = len(content)
+    archive = tarfile.open(bundle, 'w:gz')
+    try:
+        archive.addfile(info, BytesIO(content))
+        for hexdigest in sorted(set(entry['sha256'] for entry in index)):
+            archive.add(join(storage, hexdigest), arcname=hexdigest)
+    finally:
+        archive.close()
+
+
+def import_storage(bundle):
+    """Unpack libraries from archive into storage and url cache.
+
+    Libraries which content doesn't match its hash are ignored.
+    """
+
+    logger.info('Import storage from %s', bundle)
+    create_storage()
+    archive = tarfile.open(bundle)
+    try:
+        index = loads(archive.extractfile(bundle_index).read().decode())
+        for entry in index:
+            url, hexdigest = entry['url'], entry['sha256']
+            try:
+                content = archive.extractfile(hexdigest).read()
+            except KeyError:
+                logger.error('Library missed from bundle: %s', url)
+                continue
+            if sha256(content).hexdigest() != hexdigest:
+                logger.error('Library content is broken: %s', url)
+                continue
+            file_path = join(storage, hexdigest)
+            if not exists(file_path):
+                with open(file_path, 'wb') as cache_file:
+                    cache_file.write(content)
+            set_url_cache(url, hexdigest)
+    finally:
+        archive.close()
+
+
 if __name__ == '__main__':
     run_tern_django()
@@ -0,0 +1,11 @@
+"""
+    tern_django_app
+    ~~~~~~~~~~~~~~~
+
+    Django application providing tern_projects management command.
+
+    :copyright: (c) 2014-2016 by Artem Malyshev.
+    :license: GPL3, see LICENSE for more details.
+"""
+
+default_app_config = 'tern_django_app.apps.TernDjangoConfig'
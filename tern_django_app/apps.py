@@ -0,0 +1,29 @@
+"""
+    tern_django_app.apps
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Application config starting tern projects autoreload.
+
+    :copyright: (c) 2014-2016 by Artem Malyshev.
+    :license: GPL3, see LICENSE for more details.
+"""
+
+from os import environ
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class TernDjangoConfig(AppConfig):
+    """Tern django application config."""
+
+    name = 'tern_django_app'
+    verbose_name = 'Tern Django'
+
+    def ready(self):
+        """Start autoreload inside runserver reloader process."""
+
+        enabled = getattr(settings, 'TERN_DJANGO_AUTORELOAD', False)
+        if enabled and environ.get('RUN_MAIN') == 'true':
+            from tern_django_app.autoreload import start_watcher
+            start_watcher()
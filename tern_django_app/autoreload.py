@@ -0,0 +1,71 @@
+"""
+    tern_django_app.autoreload
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Update tern projects of changed applications from runserver.
+
+    :copyright: (c) 2014-2016 by Artem Malyshev.
+    :license: GPL3, see LICENSE for more details.
+"""
+
+import threading
+import time
+from os import walk
+from os.path import getmtime, join
+
+from django.conf import settings
+
+import tern_django
+
+
+def start_watcher():
+    """Start background thread watching for templates and static files."""
+
+    thread = threading.Thread(target=watch, name='tern-django')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def watch():
+    """Update tern projects of applications which files were changed."""
+
+    interval = getattr(settings, 'TERN_DJANGO_AUTORELOAD_INTERVAL', 1)
+    tern_django.init_logging(False)
+    tern_django.init_cache()
+    apps = [app for app in tern_django.applications()
+            if not tern_django.immutable_application(app)]
+    mtimes = dict((app, application_mtime(app)) for app in apps)
+    while True:
+        time.sleep(interval)
+        for app in changed_applications(apps, mtimes):
+            tern_django.update_application(app)
+
+
+def changed_applications(apps, mtimes):
+    """Find applications changed since last check.  Update mtimes."""
+
+    changed = []
+    for app in apps:
+        mtime = application_mtime(app)
+        if mtime != mtimes.get(app):
+            mtimes[app] = mtime
+            changed.append(app)
+    return changed
+
+
+def application_mtime(app):
+    """Latest modification time of application templates and static files.
+
+    Every file is checked, so files changed in place are noticed too.
+    """
+
+    latest = 0
+    for directory in ['templates', 'static']:
+        for root, dirs, files in walk(join(app, directory)):
+            for name in dirs + files:
+                try:
+                    latest = max(latest, getmtime(join(root, name)))
+                except OSError:
+                    pass        # File was removed during walk.
+    return latest
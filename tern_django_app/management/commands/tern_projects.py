@@ -0,0 +1,54 @@
+"""
+    tern_django_app.management.commands.tern_projects
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Create tern projects for django applications.
+
+    :copyright: (c) 2014-2016 by Artem Malyshev.
+    :license: GPL3, see LICENSE for more details.
+"""
+
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand
+
+import tern_django
+
+
+class Command(BaseCommand):
+    """Create tern projects for django applications."""
+
+    help = 'Create tern projects for django applications.'
+
+    if django.VERSION[:2] < (1, 8):
+        option_list = BaseCommand.option_list + (
+            make_option('--resume', action='store_true', default=False,
+                        help='Skip applications completed by previous run.'),
+            make_option('--offline', action='store_true', default=False,
+                        help='Never download external libraries.'),
+            make_option('--app', action='append', dest='targets',
+                        help='Update specified application directory only.'),
+        )
+
+    def add_arguments(self, parser):
+        """Add tern_django script options."""
+
+        parser.add_argument(
+            '--resume', action='store_true', default=False,
+            help='Skip applications completed by previous run.')
+        parser.add_argument(
+            '--offline', action='store_true', default=False,
+            help='Never download external libraries.')
+        parser.add_argument(
+            '--app', action='append', dest='targets',
+            help='Update specified application directory only.')
+
+    def handle(self, *args, **options):
+        """Update tern projects in already initialized django project."""
+
+        tern_django.init_logging(int(options.get('verbosity', 1)) > 1)
+        tern_django.init_cache()
+        tern_django.offline = options['offline']
+        tern_django.update_tern_projects(options['resume'],
+                                         targets=options['targets'])
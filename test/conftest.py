@@ -0,0 +1,49 @@
+from os import getcwd, unlink
+from os.path import exists, join
+
+import pytest
+
+import tern_django
+
+
+# Stub tern_django settings.
+
+
+tern_django.database_file = join(getcwd(), 'tern-django.sqlite')
+
+
+# Fixtures.
+
+
+@pytest.fixture
+def no_tern_projects():
+    """Remove all created tern projects before test run."""
+
+    for app in tern_django.applications():
+        project = join(app, tern_django.tern_file)
+        if exists(project):
+            unlink(project)
+
+
+@pytest.fixture(autouse=True)
+def no_urlopen(monkeypatch):
+    """Fail all http requests with URLError."""
+
+    def raise_url_error(url, *args, **kwargs):
+        raise tern_django.URLError('Monkey patch.')
+    monkeypatch.setattr(tern_django, 'urlopen', raise_url_error)
+
+
+@pytest.fixture(autouse=True)
+def db_rollback(request):
+    """Rollback any db change after test execution."""
+
+    request.addfinalizer(tern_django.drop_cache)
+    tern_django.init_cache()
+
+
+@pytest.fixture(autouse=True)
+def random_storage(tmpdir, monkeypatch):
+    """Chose storage directory randomly for each test."""
+
+    monkeypatch.setattr(tern_django, 'storage', tmpdir.strpath)
@@ -0,0 +1 @@
+var other = 'Other project application.';
@@ -0,0 +1,7 @@
+from project.settings import *  # noqa
+
+INSTALLED_APPS = (
+    'django.contrib.staticfiles',
+    'independent',
+    'other',
+)
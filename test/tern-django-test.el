@@ -8,10 +8,13 @@
 (require 'tern-django)
 
 (defmacro with-django-settings (&rest body)
-  "Terminate tern-django after BODY execution."
+  "Terminate tern-django and cancel its timer after BODY execution."
   `(let ((process-environment '("DJANGO_SETTINGS_MODULE=project.settings")))
      (unwind-protect
          ,@body
+       (when (timerp tern-django-timer)
+         (cancel-timer tern-django-timer))
+       (setq tern-django-timer nil)
        (tern-django-terminate))))
 
 (ert-deftest test-tern-django-run-command ()
@@ -61,6 +64,51 @@
                  (let ((tern-django-debug t))
                    (tern-django-args)))))
 
+(ert-deftest test-tern-django-respect-applications-option ()
+  "Check that script can be limited to specified applications."
+  (should (equal (list tern-django-script "--app" "/a" "--app" "/b")
+                 (tern-django-args '("/a" "/b")))))
+
+(ert-deftest test-tern-django-app-directory ()
+  "Check we detect application of saved template or static file."
+  (should (equal "/project/app"
+                 (tern-django-app-directory
+                  "/project/app/templates/app/index.html")))
+  (should (equal "/project/app"
+                 (tern-django-app-directory
+                  "/project/app/static/app/app.js")))
+  (should (equal "/srv/static/project/app"
+                 (tern-django-app-directory
+                  "/srv/static/project/app/static/app/app.js")))
+  (should (equal "/project/app"
+                 (tern-django-app-directory
+                  "/project/app/templates/index.html")))
+  (should-not (tern-django-app-directory "/project/app/static/app/app.css"))
+  (should-not (tern-django-app-directory "/project/app/views.js")))
+
+(ert-deftest test-tern-django-queue-saved-applications ()
+  "Check that saves while script is running don't start new process."
+  (with-django-settings
+   (let* ((default-directory tern-django-directory)
+          (tern-django-process (start-process "cat" nil "cat"))
+          (tern-django-pending-apps nil)
+          (buffer-file-name "/project/app/templates/app/index.html"))
+     (tern-django-after-save)
+     (tern-django-after-save)
+     (tern-django-run-pending)
+     (should (equal '("/project/app") tern-django-pending-apps))
+     (should (equal "cat" (car (process-command tern-django-process)))))))
+
+(ert-deftest test-tern-django-run-pending-in-background ()
+  "Check that pending applications are processed without popping buffer."
+  (with-django-settings
+   (let ((tern-django-script "-i")
+         (tern-django-pending-apps '("/project/app")))
+     (tern-django-run-pending)
+     (should (tern-django-running-p))
+     (should-not tern-django-pending-apps)
+     (should-not (equal tern-django-buffer (buffer-name))))))
+
 (provide 'tern-django-test)
 
 ;;; tern-django-test.el ends here
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+"""Differential tests.
+
+Run the same analysis in different modes and check that written tern
+projects are byte-identical.
+"""
+
+from __future__ import unicode_literals
+
+from os import getcwd, makedirs, rename, unlink, utime
+from os.path import exists, getmtime, join
+from random import Random
+from shutil import rmtree
+from time import time
+
+import pytest
+
+import tern_django
+
+
+# Constants.
+
+
+project = join(getcwd(), '.project')
+ext = join(getcwd(), 'test', 'ext')
+
+generated_app = join(project, 'independent')
+generated_templates = join(generated_app, 'templates', 'generated')
+
+backbone_js = join(ext, 'backbone.min.js')
+backbone_url = 'http://backbonejs.org/backbone-min.js'
+
+scripts = [
+    '<script src="/static/static_tag/static_tag.js"></script>',
+    '<script src="/static/independent/independent.js"></script>',
+    '<script src="/static/missed/missed.js"></script>',
+    '<script src="{% static "static_tag/static_tag.js" %}"></script>',
+    '{{ a }}<script src="{% static \'independent/independent.js\' %}">'
+    '</script>{% if a %}{% endif %}',
+    '<script src="http://code.jquery.com/jquery-1.11.1.min.js"></script>',
+    '<script src="http://underscorejs.org/underscore-min.js"></script>',
+    '<script src="' + backbone_url + '"></script>',
+    '<script src="http://example.com/unavailable.js"></script>',
+    '<script>alert("Inline.");</script>',
+]
+
+texts = [
+    '<h1>{{ title }}</h1>',
+    '<p>Webアプリケーションフレームワーク</p>',
+    '{# comment #}',
+    '<body></body>',
+]
+
+corpus_size = 30
+
+edits_count = 10
+
+# Generated templates get mtimes from the past, so edits can move them
+# forward without reaching the present.
+history_start = time() - 2 * 24 * 60 * 60
+
+
+# Helpers.
+
+
+def generate_template(rng):
+    """Create random template source."""
+
+    lines = []
+    if rng.random() < 0.5:
+        lines.append(rng.choice(['{% load staticfiles %}',
+                                 '{% load static %}']))
+    for _ in range(rng.randint(0, 6)):
+        lines.append(rng.choice(scripts + texts))
+    return '\n'.join(lines)
+
+
+def write_template(path, source, rng, previous=None):
+    """Write template and move its mtime forward from previous version."""
+
+    previous = previous or path
+    mtime = getmtime(previous) if exists(previous) else history_start
+    with open(path, 'wb') as template:
+        template.write(source.encode('utf-8'))
+    utime(path, (mtime, mtime))
+    bump_mtime(path, rng)
+
+
+def bump_mtime(path, rng):
+    """Move file mtime forward like it was edited later."""
+
+    mtime = getmtime(path) + rng.randint(1, 1000)
+    utime(path, (mtime, mtime))
+
+
+def generate_corpus(rng):
+    """Fill application with random templates."""
+
+    makedirs(join(generated_templates, 'nested'))
+    for index in range(corpus_size):
+        directory = rng.choice(
+            [generated_templates, join(generated_templates, 'nested')])
+        path = join(directory, 'generated_{0}.html'.format(index))
+        write_template(path, generate_template(rng), rng)
+
+
+def edit_corpus(rng):
+    """Randomly edit, touch, create and delete generated templates."""
+
+    for _ in range(edits_count):
+        index = rng.randrange(corpus_size * 2)
+        path = join(generated_templates, 'generated_{0}.html'.format(index))
+        action = rng.choice(['edit', 'touch', 'delete'])
+        if action == 'edit' or not exists(path):
+            write_template(path, generate_template(rng), rng)
+        elif action == 'touch':
+            bump_mtime(path, rng)
+        else:
+            unlink(path)
+
+
+def replace_corpus(rng):
+    """Randomly replace, create and delete generated templates the way
+    editors do it, so directory mtime changes each time."""
+
+    for _ in range(edits_count):
+        index = rng.randrange(corpus_size * 2)
+        path = join(generated_templates, 'generated_{0}.html'.format(index))
+        if rng.random() < 0.2 and exists(path):
+            unlink(path)
+        else:
+            temporary = path + '.tmp'
+            write_template(temporary, generate_template(rng), rng, path)
+            rename(temporary, path)
+
+
+def rewrite_corpus(rng, mtime):
+    """Randomly rewrite generated templates keeping real mtime.
+
+    All templates get the same mtime, like edits made within one tick
+    of a file system with coarse mtime resolution.
+    """
+
+    for _ in range(edits_count):
+        index = rng.randrange(corpus_size)
+        path = join(generated_templates, 'generated_{0}.html'.format(index))
+        with open(path, 'wb') as template:
+            template.write(generate_template(rng).encode('utf-8'))
+        utime(path, (mtime, mtime))
+
+
+def age_directories(mtime):
+    """Set mtime of generated template directories into the past, so
+    their snapshots can be saved."""
+
+    for directory in [join(generated_app, 'templates'), generated_templates,
+                      join(generated_templates, 'nested')]:
+        utime(directory, (mtime, mtime))
+
+
+def remove_tern_projects():
+    """Remove all created tern projects."""
+
+    for app in tern_django.applications():
+        project_file = join(app, tern_django.tern_file)
+        if exists(project_file):
+            unlink(project_file)
+
+
+def tern_projects():
+    """Read contents of all written tern projects.
+
+    Installed applications must never get one.
+    """
+
+    contents = {}
+    for app in tern_django.applications():
+        project_file = join(app, tern_django.tern_file)
+        if tern_django.immutable_application(app):
+            assert not exists(project_file)
+        elif exists(project_file):
+            with open(project_file, 'rb') as project_content:
+                contents[app] = project_content.read()
+    return contents
+
+
+def run_serial():
+    """Update all applications in current process."""
+
+    for app in tern_django.applications():
+        tern_django.update_application(app)
+    return tern_projects()
+
+
+def run_pooled():
+    """Update all applications with worker pool."""
+
+    tern_django.update_tern_projects()
+    return tern_projects()
+
+
+def cold(run):
+    """Run analysis from scratch."""
+
+    tern_django.drop_cache()
+    tern_django.init_cache()
+    remove_tern_projects()
+    return run()
+
+
+# Fixtures.
+
+
+@pytest.fixture(autouse=True)
+def no_urlopen(monkeypatch):
+    """Serve backbone fixture, fail all other http requests."""
+
+    def urlopen(url, *args, **kwargs):
+        if url == backbone_url:
+            return open(backbone_js)
+        raise tern_django.URLError('Monkey patch.')
+    monkeypatch.setattr(tern_django, 'urlopen', urlopen)
+
+
+@pytest.fixture(params=[0, 1, 2])
+def rng(request):
+    """Generate random template corpus.  Remove it after test."""
+
+    def remove_corpus():
+        rmtree(generated_templates, ignore_errors=True)
+        remove_tern_projects()
+    request.addfinalizer(remove_corpus)
+    remove_corpus()
+    rng = Random(request.param)
+    generate_corpus(rng)
+    return rng
+
+
+# Differential tests.
+
+
+def test_fixture_project_cold_and_warm():
+    """Check fixture project gives same results with cold and warm cache."""
+
+    expected = cold(run_serial)
+    assert expected == run_serial()
+    assert expected == run_pooled()
+
+
+def test_cold_and_warm_cache(rng):
+    """Check warm cache gives same results as cold one."""
+
+    expected = cold(run_serial)
+    assert expected == run_serial()
+    assert expected == run_serial()
+
+
+def test_serial_and_pooled(rng):
+    """Check worker pool gives same results as single process."""
+
+    expected = cold(run_serial)
+    assert expected == cold(run_pooled)
+    assert expected == run_pooled()
+
+
+def test_after_random_edits(rng):
+    """Check warm cache gives same results as cold one after edits."""
+
+    cold(run_serial)
+    for _ in range(3):
+        edit_corpus(rng)
+        warm = run_pooled()
+        assert cold(run_serial) == warm
+
+
+def test_edits_within_mtime_tick(rng):
+    """Check templates edited again within mtime tick aren't served stale.
+    """
+
+    cold(run_serial)
+    for _ in range(3):
+        mtime = int(time())
+        rewrite_corpus(rng, mtime)
+        run_serial()
+        rewrite_corpus(rng, mtime)
+        warm = run_serial()
+        assert cold(run_serial) == warm
+
+
+def test_trusted_directories_after_edits(rng, monkeypatch):
+    """Check directory snapshots give same results as full scan."""
+
+    age_directories(history_start)
+    expected = cold(run_serial)
+    monkeypatch.setattr(tern_django, 'trust_directories', True)
+    assert expected == run_serial()
+    for index in range(3):
+        replace_corpus(rng)
+        age_directories(history_start + index + 1)
+        warm = run_serial()
+        monkeypatch.setattr(tern_django, 'trust_directories', False)
+        assert cold(run_serial) == warm
+        monkeypatch.setattr(tern_django, 'trust_directories', True)
+        assert warm == run_serial()
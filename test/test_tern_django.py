@@ -1,7 +1,11 @@
+import cProfile
+import pstats
+import sys
 from datetime import datetime, timedelta
 from json import dumps
-from os import getcwd, unlink
-from os.path import join, exists
+from os import environ, getcwd, unlink, utime
+from os.path import exists, getmtime, join
+from subprocess import PIPE, Popen
 from time import mktime
 
 import pytest
@@ -9,12 +13,6 @@ import pytest
 import tern_django
 
 
-# Stub tern_django settings.
-
-
-tern_django.database_file = join(getcwd(), 'tern-django.sqlite')
-
-
 # Constants.
 
 
@@ -23,12 +21,15 @@ ext = join(getcwd(), 'test', 'ext')
 
 independent_app = join(project, 'independent')
 independent_app_project = join(independent_app, tern_django.tern_file)
-independent_app_js = join(
-    independent_app, 'static', 'independent', 'independent.js')
+independent_app_static = join(independent_app, 'static', 'independent')
+independent_app_js = join(independent_app_static, 'independent.js')
 
 static_tag_app = join(project, 'static_tag')
 static_tag_app_project = join(static_tag_app, tern_django.tern_file)
 
+other_app = join(project, 'other')
+other_app_project = join(other_app, tern_django.tern_file)
+
 use_jquery_app = join(project, 'use_jquery')
 
 cached_app = join(project, 'cached')
@@ -67,43 +68,6 @@ def make_timestamp(**kwargs):
     return mktime(time_tuple)
 
 
-# Fixtures.
-
-
-@pytest.fixture
-def no_tern_projects():
-    """Remove all created tern projects before test run."""
-
-    for app in tern_django.applications():
-        project = join(app, tern_django.tern_file)
-        if exists(project):
-            unlink(project)
-
-
-@pytest.fixture(autouse=True)
-def no_urlopen(monkeypatch):
-    """Fail all http requests with URLError."""
-
-    def raise_url_error(url, *args, **kwargs):
-        raise tern_django.URLError('Monkey patch.')
-    monkeypatch.setattr(tern_django, 'urlopen', raise_url_error)
-
-
-@pytest.fixture(autouse=True)
-def db_rollback(request):
-    """Rollback any db change after test execution."""
-
-    request.addfinalizer(tern_django.drop_cache)
-    tern_django.init_cache()
-
-
-@pytest.fixture(autouse=True)
-def random_storage(tmpdir, monkeypatch):
-    """Chose storage directory randomly for each test."""
-
-    monkeypatch.setattr(tern_django, 'storage', tmpdir.strpath)
-
-
 # Applications.
 
 
@@ -124,7 +88,29 @@ def test_write_tern_project(no_tern_projects):
     for app in tern_django.applications():
         has_static = exists(join(app, 'static'))
         has_tern = exists(join(app, tern_django.tern_file))
-        assert has_static == has_tern
+        if tern_django.immutable_application(app):
+            assert not has_tern
+        else:
+            assert has_static == has_tern
+
+
+def test_immutable_application():
+    """Check we detect applications installed into site-packages."""
+
+    assert tern_django.immutable_application(
+        '/venv/lib/python3.4/site-packages/django/contrib/admin')
+    assert tern_django.immutable_application(
+        '/usr/lib/python2.7/dist-packages/django/contrib/admin')
+    assert not tern_django.immutable_application(independent_app)
+
+
+def test_update_immutable_application(tmpdir):
+    """Check we don't write tern project into installed application."""
+
+    app = tmpdir.join('site-packages', 'admin')
+    app.join('static').ensure(dir=True)
+    assert 'done' == tern_django.update_application(app.strpath)
+    assert not app.join(tern_django.tern_file).check()
 
 
 def test_does_not_modify_existed_files(capsys, no_tern_projects):
@@ -137,6 +123,260 @@ def test_does_not_modify_existed_files(capsys, no_tern_projects):
     assert independent_app_project not in out
 
 
+def test_isolate_application_errors(monkeypatch):
+    """Check unexpected error in one application doesn't break the run."""
+
+    def raise_error(app, failures=None):
+        raise RuntimeError('Monkey patch.')
+    monkeypatch.setattr(tern_django, 'analyze_templates', raise_error)
+    assert 'failed' == tern_django.update_application(independent_app)
+    assert 'failed' == tern_django.get_app_cache(independent_app)
+
+
+def test_save_application_progress(no_tern_projects):
+    """Check we save completed application status into cache."""
+
+    assert 'done' == tern_django.update_application(independent_app)
+    assert 'done' == tern_django.get_app_cache(independent_app)
+
+
+def test_collect_failed_templates():
+    """Check we remember templates failed to download its libraries."""
+
+    failures = []
+    tern_django.analyze_templates(use_backbone_app, failures)
+    assert [use_backbone_app_html] == failures
+
+
+def test_resume_skip_completed_applications(no_tern_projects):
+    """Check resume run skips applications completed earlier."""
+
+    tern_django.set_app_cache(independent_app, 'done')
+    tern_django.update_tern_projects(resume=True)
+    assert not exists(independent_app_project)
+    assert exists(static_tag_app_project)
+
+
+def test_clear_progress_without_resume(no_tern_projects):
+    """Check regular run starts from scratch."""
+
+    tern_django.set_app_cache(independent_app, 'done')
+    tern_django.update_tern_projects()
+    assert exists(independent_app_project)
+
+
+def test_update_multiple_projects(tmpdir, no_tern_projects):
+    """Check we can process several django projects in one run.
+
+    Coordinator runs in separate process without django settings, so
+    each worker group must set up its own project.
+    """
+
+    tmpdir.mkdir('.emacs.d')
+    if exists(other_app_project):
+        unlink(other_app_project)
+    env = dict(environ, HOME=tmpdir.strpath)
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    process = Popen([sys.executable, '-c',
+                     'import tern_django; tern_django.run_tern_django()',
+                     '--debug',
+                     '--settings', 'project.settings,project.other_settings'],
+                    env=env, stderr=PIPE)
+    out, err = process.communicate()
+    err = err.decode()
+    assert 0 == process.returncode, err
+    assert exists(independent_app_project)
+    assert exists(static_tag_app_project)
+    assert exists(other_app_project)
+    assert 1 == err.count('Update application: ' + independent_app + '\n')
+    unlink(other_app_project)
+
+
+def test_multiple_projects_need_unconfigured_django():
+    """Check we refuse to process other projects with django set up."""
+
+    tern_django.applications()
+    with pytest.raises(RuntimeError):
+        tern_django.update_tern_projects(
+            settings_modules=['project.other_settings'])
+
+
+def test_process_shared_applications_once():
+    """Check application shared between projects is processed once."""
+
+    projects = [['/a', '/b'], ['/b', '/c']]
+    assert [['/a', '/b'], ['/c']] == tern_django.project_applications(
+        projects)
+
+
+def test_resume_multiple_projects():
+    """Check resume mode skips completed applications in each project."""
+
+    tern_django.set_app_cache('/b', 'done')
+    projects = [['/a', '/b'], ['/b', '/c']]
+    assert [['/a'], ['/c']] == tern_django.project_applications(
+        projects, resume=True)
+
+
+def test_update_target_applications(no_tern_projects):
+    """Check we can update only specified applications."""
+
+    tern_django.update_tern_projects(targets=[independent_app + '/'])
+    assert exists(independent_app_project)
+    assert not exists(static_tag_app_project)
+
+
+def test_prioritize_recently_changed_applications():
+    """Check recently changed applications are processed first."""
+
+    mtime = tern_django.directories_mtime(static_tag_app) + 10
+    utime(independent_app_static, (mtime, mtime))
+    apps = [static_tag_app, independent_app]
+    assert [independent_app, static_tag_app] == (
+        tern_django.prioritize_applications(apps))
+
+
+def test_prioritize_incomplete_applications():
+    """Check applications not completed by previous run go first."""
+
+    apps = [static_tag_app, independent_app]
+    previous = set([independent_app])
+    assert [static_tag_app, independent_app] == (
+        tern_django.prioritize_applications(apps, previous))
+
+
+def test_skip_applications_after_deadline(monkeypatch, no_tern_projects):
+    """Check worker doesn't start applications after deadline."""
+
+    monkeypatch.setattr(tern_django, 'deadline', 0)
+    assert 'skipped' == tern_django.process_application(independent_app)
+    assert not exists(independent_app_project)
+    assert not tern_django.get_app_cache(independent_app)
+
+
+def test_exceeded_time_budget(no_tern_projects):
+    """Check run with exceeded time budget leaves applications for the
+    next run."""
+
+    tern_django.update_tern_projects(budget=-1)
+    assert not exists(independent_app_project)
+
+
+# Eager loading.
+
+
+def test_eager_files_dedupe_by_content(tmpdir):
+    """Check we load same library once preferring the storage copy."""
+
+    stored = join(tern_django.storage, backbone_sha256)
+    vendored = tmpdir.join('backbone.js')
+    with open(backbone_js) as fixture:
+        content = fixture.read()
+    with open(stored, 'w') as stored_file:
+        stored_file.write(content)
+    vendored.write(content)
+    eager = tern_django.eager_files(independent_app,
+                                    [vendored.strpath, stored])
+    assert [stored] == eager
+
+
+def test_eager_files_prefer_application_copy(tmpdir):
+    """Check we don't load other copy of application own static file."""
+
+    copy = tmpdir.join('independent.js')
+    with open(independent_app_js) as original:
+        copy.write(original.read())
+    eager = tern_django.eager_files(
+        independent_app, [tern_django.static_pattern, copy.strpath])
+    assert [tern_django.static_pattern] == eager
+
+
+def test_eager_files_prefer_unminified(tmpdir):
+    """Check we use non minified library placed next to minified one."""
+
+    tmpdir.join('lib.min.js').write('var a;')
+    tmpdir.join('lib.js').write('var library;')
+    eager = tern_django.eager_files(
+        independent_app, [tmpdir.join('lib.min.js').strpath])
+    assert [tmpdir.join('lib.js').strpath] == eager
+
+
+def test_eager_files_budget(tmpdir, monkeypatch):
+    """Check we skip libraries which don't fit into the budget."""
+
+    monkeypatch.setattr(tern_django, 'eager_budget', 10)
+    tmpdir.join('small.js').write('var a;')
+    tmpdir.join('large.js').write('var a, b, c, d;')
+    eager = tern_django.eager_files(
+        independent_app, [tmpdir.join('large.js').strpath,
+                          tmpdir.join('small.js').strpath])
+    assert [tmpdir.join('small.js').strpath] == eager
+
+
+def test_file_hash_from_cache(tmpdir, monkeypatch):
+    """Check we don't read unchanged file hashed by previous run."""
+
+    monkeypatch.setattr(tern_django, 'file_hashes', {})
+    lib = tmpdir.join('lib.js')
+    lib.write('var a;')
+    timestamp = make_timestamp(hours=-1)
+    utime(lib.strpath, (timestamp, timestamp))
+    tern_django.set_hash_cache(lib.strpath, getmtime(lib.strpath), 6,
+                               'cached')
+    assert 'cached' == tern_django.file_hash(lib.strpath)
+
+
+def test_save_file_hash(tmpdir):
+    """Check we save hash of file not changed within mtime tick only."""
+
+    old, recent = tmpdir.join('old.js'), tmpdir.join('recent.js')
+    old.write('var a;')
+    recent.write('var a;')
+    timestamp = make_timestamp(hours=-1)
+    utime(old.strpath, (timestamp, timestamp))
+    tern_django.file_hash(old.strpath)
+    tern_django.file_hash(recent.strpath)
+    assert tern_django.get_hash_cache(old.strpath)
+    assert not tern_django.get_hash_cache(recent.strpath)
+
+
+# Profiling.
+
+
+def test_profile_pool_worker(tmpdir, monkeypatch):
+    """Check worker saves its profile statistics into profile directory."""
+
+    monkeypatch.setattr(tern_django, 'profile_directory', tmpdir.strpath)
+    tern_django.process_application(independent_app)
+    assert 1 == len(tmpdir.listdir())
+
+
+def test_profile_tern_projects(tmpdir, no_tern_projects):
+    """Check we merge profile statistics of all processes."""
+
+    profile = tmpdir.join('tern-django.prof')
+    collapsed = tmpdir.join('tern-django.collapsed')
+    tern_django.profile_tern_projects(profile.strpath, collapsed.strpath)
+    stats = pstats.Stats(profile.strpath)
+    functions = [name for file_name, line, name in stats.stats]
+    assert 'update_tern_projects' in functions
+    assert 'update_application' in functions
+    assert 'update_application' in collapsed.read()
+
+
+def test_collapsed_stacks_limit(tmpdir, monkeypatch):
+    """Check deep calls are merged into callers after stacks limit."""
+
+    monkeypatch.setattr(tern_django, 'collapsed_stacks_limit', 1)
+    profiler = cProfile.Profile()
+    profiler.runcall(tern_django.merge_projects,
+                     tern_django.default_tern_project)
+    collapsed = tmpdir.join('tern-django.collapsed')
+    tern_django.write_collapsed_stacks(pstats.Stats(profiler),
+                                       collapsed.strpath)
+    assert all(';' not in line for line in collapsed.readlines())
+
+
 # Templates analyze.
 
 
@@ -168,13 +408,77 @@ def test_meaningful_template():
     assert not tern_django.meaningful_template('<body></body>')
 
 
+def test_scan_template_raw_bytes(tmpdir):
+    """Check we can detect meaningful templates without decoding them."""
+
+    html = tmpdir.join('scan.html')
+    html.write('{% load staticfiles %}<script src="/a.js"></script>')
+    with open(html.strpath, 'rb') as template:
+        assert tern_django.scan_template(template) == (True, True)
+    html.write('<body></body>')
+    with open(html.strpath, 'rb') as template:
+        assert tern_django.scan_template(template) == (False, False)
+
+
+def test_scan_empty_template(tmpdir):
+    """Check we skip empty templates which can't be memory mapped."""
+
+    html = tmpdir.join('empty.html')
+    html.write('')
+    with open(html.strpath, 'rb') as template:
+        assert tern_django.scan_template(template) == (False, False)
+
+
+def test_template_chunks_split_on_lines(tmpdir, monkeypatch):
+    """Check template tags survive chunked reading of rendered templates."""
+
+    monkeypatch.setattr(tern_django, 'chunk_size', 8)
+    html = tmpdir.join('chunks.html')
+    html.write('<h1>{{ title }}</h1>\n<script src="/a.js"></script>\n')
+    with open(html.strpath, 'rb') as template:
+        chunks = list(tern_django.template_chunks(template, True))
+    assert ''.join(chunks) == '<h1></h1>\n<script src="/a.js"></script>\n'
+    assert all(chunk.endswith('\n') for chunk in chunks)
+
+
+def test_template_lexer_for_django_version(monkeypatch):
+    """Check we choose lexer signature by django version numbers."""
+
+    monkeypatch.setattr(tern_django.django, 'VERSION', (1, 10, 0, 'final', 0))
+    monkeypatch.setattr(tern_django, 'Lexer', lambda *args: args)
+    assert ('{{ a }}',) == tern_django.template_lexer('{{ a }}')
+    monkeypatch.setattr(tern_django.django, 'VERSION', (1, 8, 0, 'final', 0))
+    assert ('{{ a }}', None) == tern_django.template_lexer('{{ a }}')
+
+
 def test_needs_to_be_rendered():
     """Test if we need render specified template."""
 
     assert tern_django.needs_to_be_rendered('<h1>{% load staticfiles %}</h1>')
+    assert tern_django.needs_to_be_rendered('<h1>{% load static %}</h1>')
+    assert tern_django.needs_to_be_rendered('{% load i18n static %}')
+    assert not tern_django.needs_to_be_rendered('{% load i18n %}')
     assert not tern_django.needs_to_be_rendered('<body></body>')
 
 
+def test_render_static_tags_only():
+    """Check we render static tags next to other tags on the same line."""
+
+    source = ('{% load static %}{{ a }}<script src="{% static \'x.js\' %}">'
+              '</script>{% if a %}{# comment #}{% endif %}')
+    rendered = tern_django.render_chunk(source)
+    assert '<script src="/static/x.js"></script>' == rendered
+
+
+def test_ignore_malformed_static_tags():
+    """Check malformed static tags are rendered as empty strings."""
+
+    source = ('{% load static %}<script src="{% static %}"></script>'
+              '<script src="{% static \'x.js\'|nosuch %}"></script>')
+    rendered = tern_django.render_chunk(source)
+    assert '<script src=""></script><script src=""></script>' == rendered
+
+
 def test_template_rendering():
     """Test we can render any template."""
 
@@ -190,6 +494,40 @@ def test_template_unicode_processing():
     tern_django.analyze_templates(rendering_app)
 
 
+def test_template_files(tmpdir):
+    """Check we find html templates in nested directories."""
+
+    tmpdir.join('a.html').write('')
+    tmpdir.join('b.txt').write('')
+    tmpdir.mkdir('nested').join('c.html').write('')
+    files = [html for html, mtime in tern_django.template_files(
+        tmpdir.strpath)]
+    assert [tmpdir.join('a.html').strpath,
+            tmpdir.join('nested', 'c.html').strpath] == files
+
+
+def test_template_files_trust_directory_mtime(tmpdir, monkeypatch):
+    """Check we don't stat files of unchanged directory in trust mode."""
+
+    monkeypatch.setattr(tern_django, 'trust_directories', True)
+    html = tmpdir.join('a.html')
+    html.write('')
+    timestamp = make_timestamp(hours=-1)
+    utime(tmpdir.strpath, (timestamp, timestamp))
+    listed = tern_django.template_files(tmpdir.strpath)
+    utime(html.strpath, (timestamp, timestamp))
+    assert listed == tern_django.template_files(tmpdir.strpath)
+    tmpdir.join('b.html').write('')
+    assert 2 == len(tern_django.template_files(tmpdir.strpath))
+
+
+def test_missed_templates_directory():
+    """Check applications without templates have no template files."""
+
+    assert [] == tern_django.template_files(join(independent_app,
+                                                 'templates'))
+
+
 # Sql cache.
 
 
@@ -230,6 +568,15 @@ def test_url_cache_table_operations():
     assert sha == tern_django.get_url_cache(url)
 
 
+def test_url_cache_table_insert_or_update():
+    """Check that set_url_cache replaces record saved by other worker."""
+
+    url = 'http://example.com'
+    tern_django.set_url_cache(url, 'first')
+    tern_django.set_url_cache(url, 'second')
+    assert 'second' == tern_django.get_url_cache(url)
+
+
 # Cache integration with templates analyze.
 
 
@@ -242,6 +589,35 @@ def test_skip_already_analyzed_template():
     assert project == {'libs': ['jquery'], 'loadEagerly': []}
 
 
+def test_skip_unchanged_template():
+    """Check we use cache for templates not modified since analysis."""
+
+    tern_django.set_html_cache(
+        cached_app_html, getmtime(cached_app_html), '["jquery"]', '')
+    project = tern_django.analyze_templates(cached_app)
+    assert project == {'libs': ['jquery'], 'loadEagerly': []}
+
+
+def test_skip_cached_template_without_scripts(tmpdir):
+    """Check cached templates without scripts give empty project."""
+
+    html = tmpdir.join('empty.html')
+    html.write('<body></body>')
+    timestamp = make_timestamp(hours=-1)
+    utime(html.strpath, (timestamp, timestamp))
+    tern_django.set_template_cache(html.strpath)
+    assert ([], []) == tern_django.get_template_cache(html.strpath)
+
+
+def test_recheck_recently_changed_template(tmpdir):
+    """Check we don't trust cache of template changed within mtime tick."""
+
+    html = tmpdir.join('recent.html')
+    html.write('<body></body>')
+    tern_django.set_template_cache(html.strpath)
+    assert not tern_django.get_template_cache(html.strpath)
+
+
 def test_save_analyzed_template_data():
 
     timestamp = make_timestamp(hours=-1)
@@ -313,3 +689,55 @@ def test_download_library_ignore_cached_results_missed_from_storage():
     tern_django.download_library(backbone_url)
     assert exists(join(tern_django.storage, backbone_sha256))
     assert backbone_sha256 == tern_django.get_url_cache(backbone_url)
+
+
+def test_offline_mode_skip_download(monkeypatch):
+    """Check we never touch network in offline mode."""
+
+    monkeypatch.setattr(tern_django, 'offline', True)
+    tern_django.urlopen = lambda url: open(backbone_js)
+    with pytest.raises(tern_django.URLError):
+        tern_django.download_library(backbone_url)
+    assert not tern_django.get_url_cache(backbone_url)
+
+
+def test_offline_mode_use_stored_libraries(monkeypatch):
+    """Check we resolve libraries from storage in offline mode."""
+
+    tern_django.urlopen = lambda url: open(backbone_js)
+    downloaded = tern_django.download_library(backbone_url)
+    monkeypatch.setattr(tern_django, 'offline', True)
+    assert downloaded == tern_django.download_library(backbone_url)
+
+
+# Storage bundles.
+
+
+def test_export_import_storage(tmpdir, monkeypatch):
+    """Check we can move url cache and stored libraries to other machine."""
+
+    bundle = tmpdir.join('bundle.tar.gz').strpath
+    tern_django.urlopen = lambda url: open(backbone_js)
+    tern_django.download_library(backbone_url)
+    tern_django.export_storage(bundle)
+    tern_django.drop_cache()
+    tern_django.init_cache()
+    monkeypatch.setattr(tern_django, 'storage', tmpdir.join('new').strpath)
+    tern_django.import_storage(bundle)
+    assert backbone_sha256 == tern_django.get_url_cache(backbone_url)
+    assert exists(join(tern_django.storage, backbone_sha256))
+
+
+def test_import_storage_ignore_broken_libraries(tmpdir):
+    """Check we don't import libraries which content doesn't match its hash.
+    """
+
+    bundle = tmpdir.join('bundle.tar.gz').strpath
+    tern_django.set_url_cache(backbone_url, backbone_sha256)
+    with open(join(tern_django.storage, backbone_sha256), 'w') as stored:
+        stored.write('Broken content.')
+    tern_django.export_storage(bundle)
+    tern_django.drop_cache()
+    tern_django.init_cache()
+    tern_django.import_storage(bundle)
+    assert not tern_django.get_url_cache(backbone_url)
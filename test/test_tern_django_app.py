@@ -0,0 +1,55 @@
+from os import getcwd, utime
+from os.path import exists, join
+
+from django.core.management import call_command
+
+import tern_django
+from tern_django_app import autoreload
+
+
+# Constants.
+
+
+project = join(getcwd(), '.project')
+
+independent_app = join(project, 'independent')
+independent_app_project = join(independent_app, tern_django.tern_file)
+independent_app_js = join(
+    independent_app, 'static', 'independent', 'independent.js')
+
+static_tag_app = join(project, 'static_tag')
+static_tag_app_project = join(static_tag_app, tern_django.tern_file)
+
+
+# Management command.
+
+
+def test_tern_projects_command(no_tern_projects):
+    """Check we can create tern projects with management command."""
+
+    call_command('tern_projects')
+    assert exists(independent_app_project)
+    assert exists(static_tag_app_project)
+
+
+def test_tern_projects_command_targets(no_tern_projects):
+    """Check management command can update specified applications only."""
+
+    call_command('tern_projects', targets=[independent_app])
+    assert exists(independent_app_project)
+    assert not exists(static_tag_app_project)
+
+
+# Autoreload.
+
+
+def test_detect_changed_applications():
+    """Check we detect applications with changed static files."""
+
+    apps = [independent_app, static_tag_app]
+    mtimes = dict((app, autoreload.application_mtime(app)) for app in apps)
+    assert [] == autoreload.changed_applications(apps, mtimes)
+    mtime = autoreload.application_mtime(independent_app) + 10
+    utime(independent_app_js, (mtime, mtime))
+    assert [independent_app] == autoreload.changed_applications(apps, mtimes)
+    assert [] == autoreload.changed_applications(apps, mtimes)